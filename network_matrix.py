@@ -5,10 +5,14 @@ network_matrix.py
 """
 #### Libraries
 # Standard library
-import random
+import contextlib
+import operator
+import os
+import time
 
 # Third-party libraries
 import numpy as np
+from scipy.special import expit
 
 
 class QuadraticCost(object):
@@ -22,9 +26,17 @@ class QuadraticCost(object):
         return 0.5 * np.linalg.norm(a - y) ** 2
 
     @staticmethod
-    def delta(Z, A, Y):
-        """Return the error delta from the output layer."""
-        return (A - Y) * sigmoid_prime(Z)
+    def output(z, out=None):
+        """Return the output layer activation for weighted input ``z``."""
+        return sigmoid(z, out=out)
+
+    @staticmethod
+    def delta(Z, A, Y, out=None):
+        """Return the error delta from the output layer, written into
+        ``out`` if it is given."""
+        out = np.subtract(A, Y, out=out)
+        out *= sigmoid_prime_from_a(A)
+        return out
 
 
 class CrossEntropyCost(object):
@@ -42,45 +54,89 @@ class CrossEntropyCost(object):
         return np.sum(np.nan_to_num(-y * np.log(a) - (1 - y) * np.log(1 - a)))
 
     @staticmethod
-    def delta(Z, A, Y):
-        """Return the error delta from the output layer.  Note that the
-        parameter ``z`` is not used by the method.  It is included in
-        the method's parameters in order to make the interface
-        consistent with the delta method for other cost classes.
+    def output(z, out=None):
+        """Return the output layer activation for weighted input ``z``."""
+        return sigmoid(z, out=out)
+
+    @staticmethod
+    def delta(Z, A, Y, out=None):
+        """Return the error delta from the output layer, written into
+        ``out`` if it is given.  Note that the parameter ``z`` is not
+        used by the method.  It is included in the method's parameters
+        in order to make the interface consistent with the delta method
+        for other cost classes.
+
+        """
+        return np.subtract(A, Y, out=out)
+
+
+class SoftmaxCrossEntropyCost(object):
+
+    @staticmethod
+    def fn(a, y):
+        """Return the log-likelihood cost associated with a softmax output
+        ``a`` and desired one-hot output ``y``.  ``a`` is computed by
+        ``softmax`` with the max subtracted from ``z``, so it does not
+        overflow; np.nan_to_num converts ``0 * log(0)`` to 0.0.
 
         """
-        return A - Y
+        return np.sum(np.nan_to_num(-y * np.log(a)))
+
+    @staticmethod
+    def output(z, out=None):
+        """Return the output layer activation for weighted input ``z``."""
+        return softmax(z, out=out)
+
+    @staticmethod
+    def delta(Z, A, Y, out=None):
+        """Return the error delta from the output layer, written into
+        ``out`` if it is given.  For a softmax output layer with the
+        log-likelihood cost this is the same ``A - Y`` as for
+        ``CrossEntropyCost``; ``Z`` is unused.
+
+        """
+        return np.subtract(A, Y, out=out)
 
 
 class L2_regularization(object):
     """implements update step for L2_regularized cost function"""
 
     def update_step(eta, lmbda, n, weights, biases, nabla_w, nabla_b, velocities, mu):
-        weights = [
-            (1 - eta * lmbda / n) * w - (eta) * nw for w, nw in zip(weights, nabla_w)
-        ]
-        biases = [b - (eta) * nb for b, nb in zip(biases, nabla_b)]
+        # update parameters in place rather than building new lists of arrays
+        scale = 1 - eta * lmbda / n
+        for w, nw in zip(weights, nabla_w):
+            w *= scale
+            w -= eta * nw
+        for b, nb in zip(biases, nabla_b):
+            b -= eta * nb
         return weights, biases, velocities
 
 
 class momentum(object):
     def update_step(eta, lmbda, n, weights, biases, nabla_w, nabla_b, velocities, mu):
-        velocities = [mu * v - eta * nw for v, nw in zip(velocities, nabla_w)]
-        weights = [w + v for w, v in zip(weights, velocities)]
-        biases = [b - (eta) * nb for b, nb in zip(biases, nabla_b)]
+        for w, v, nw in zip(weights, velocities, nabla_w):
+            v *= mu
+            v -= eta * nw
+            w += v
+        for b, nb in zip(biases, nabla_b):
+            b -= eta * nb
         return weights, biases, velocities
 
 
 class L1_regularization(object):
     """implements update step for L1_regularized cost function"""
 
-    def update_step(eta, lmbda, n, weights, biases, nabla_w, nabla_b):
-        weights = [
-            w - (eta * lmbda / n) * np.sign(w) - eta * nw
-            for w, nw in zip(weights, nabla_w)
-        ]
-        biases = [b - (eta) * nb for b, nb in zip(biases, nabla_b)]
-        return weights, biases
+    def update_step(eta, lmbda, n, weights, biases, nabla_w, nabla_b, velocities, mu):
+        for w, nw in zip(weights, nabla_w):
+            # w -= eta * (lmbda/n * sign(w) + nw), built up in one scratch array
+            step = np.sign(w)
+            step *= lmbda / n
+            step += nw
+            step *= eta
+            w -= step
+        for b, nb in zip(biases, nabla_b):
+            b -= eta * nb
+        return weights, biases, velocities
 
 
 class EarlyStopping:
@@ -88,10 +144,8 @@ class EarlyStopping:
         self.patience = patience
         self.best_accuracy = 0
         self.counter = 0
-        self.accuracies = []
 
     def should_stop(self, current_accuracy):
-        self.accuracies.append(current_accuracy)
         if current_accuracy > self.best_accuracy:
             self.best_accuracy = current_accuracy
             self.counter = 0
@@ -109,10 +163,8 @@ class LearningRate:
         self.best_accuracy = 0
         self.counter = 0
         self.num_halves = 0
-        self.accuracies = []
 
     def should_halve(self, current_accuracy):
-        self.accuracies.append(current_accuracy)
         if current_accuracy > self.best_accuracy:
             self.best_accuracy = current_accuracy
             self.counter = 0
@@ -152,18 +204,23 @@ class Network(object):
         self.cost = cost
         self.reg = reg
         self.learning_rate = LearningRate(patience)
+        self._buffer_key = None  # (minibatch size, dtype) the buffers fit
+        self._buffer_sets = {}  # backprop buffers, keyed like _buffer_key
 
     def default_weight_initializer(self):
-        """Initializes weights as N(0, 1/n_in)"""
+        """Initializes weights as N(0, 1/n_in).  All parameters are stored
+        as float32, which halves the memory traffic of every matrix
+        product and elementwise op during training."""
         self.biases = [
-            np.random.randn(y, 1) for y in self.sizes[1:]
+            np.random.randn(y, 1).astype(np.float32) for y in self.sizes[1:]
         ]  # each element in list is a column vector of the biases, b^l
         self.weights = [
-            np.random.randn(y, x)
-            / np.sqrt(x)  # each element in list is weight matrix W^l
+            (np.random.randn(y, x) / np.sqrt(x)).astype(
+                np.float32
+            )  # each element in list is weight matrix W^l
             for x, y in zip(self.sizes[:-1], self.sizes[1:])
         ]
-        self.velocities = [np.zeros(w.shape) for w in self.weights]
+        self.velocities = [np.zeros(w.shape, dtype=np.float32) for w in self.weights]
 
     def SGD(
         self,
@@ -174,6 +231,8 @@ class Network(object):
         lmbda=0.0,
         mu=0.5,
         test_data=None,
+        accum_steps=1,
+        nthreads=None,
     ):
         """Train the neural network using mini-batch stochastic
         gradient descent.  The ``training_data`` is a list of tuples
@@ -182,49 +241,119 @@ class Network(object):
         self-explanatory.  If ``test_data`` is provided then the
         network will be evaluated against the test data after each
         epoch, and partial progress printed out.  This is useful for
-        tracking progress, but slows things down substantially."""
+        tracking progress, but slows things down substantially.
+
+        ``accum_steps`` groups that many consecutive minibatches into a
+        single forward and backward pass with one averaged update, so
+        the effective batch size is ``mini_batch_size * accum_steps``.
+        Larger products keep the matrix multiplies efficient at the
+        cost of fewer weight updates per epoch.
+
+        ``nthreads`` caps the number of BLAS threads used during
+        training (this requires ``threadpoolctl``).  For small layers
+        and minibatches a few threads are often faster than all of
+        them; pass ``"auto"`` to time a minibatch at several thread
+        counts and use the fastest."""
+
+        # check the arguments before the (slow) stacking of the data
+        accum_steps = _positive_int("accum_steps", accum_steps)
+        if nthreads is not None and not (
+            isinstance(nthreads, str) and nthreads == "auto"
+        ):
+            nthreads = _positive_int("nthreads", nthreads, "or 'auto'")
 
         training_data = list(training_data)
         n = len(training_data)
+        # stack the whole training set once: column k is training example k.
+        # Fortran order keeps each example contiguous, so the per-epoch
+        # shuffle below gathers whole columns (see there for minibatches)
+        X_all = np.asfortranarray(
+            np.column_stack([x for x, y in training_data]), dtype=np.float32
+        )
+        Y_all = np.asfortranarray(
+            np.column_stack([y for x, y in training_data]), dtype=np.float32
+        )
 
         if test_data:
             test_data = list(test_data)
             n_test = len(test_data)
+            # stack the test set once per run rather than once per epoch
+            X_test, test_labels = stack_test_data(test_data)
 
-        for j in range(epochs):
-            random.shuffle(training_data)
-            mini_batches = [
-                training_data[k : k + mini_batch_size]
-                for k in range(0, n, mini_batch_size)
-            ]
-            for mini_batch in mini_batches:
-                self.update_mini_batch(mini_batch, eta, lmbda, n, mu)
-
-            corrects = self.evaluate(test_data)
-
-            if test_data:
-                print("Epoch {} : {} / {}".format(j, corrects, n_test))
-            else:
-                print("Epoch {} complete".format(j))
-
-            if self.learning_rate.should_halve(corrects):
-                eta /= 2
-                print(f"learning halved to: {eta}")
-
-            num_halves = self.learning_rate.get_num_halves()
-            print(f"num halves: {num_halves}")
-            if num_halves >= 7:  # stop training when learning_rate is 1/128 of original
-                break
-
-    def update_mini_batch(self, mini_batch, eta, lmbda, n, mu):
+        batch_size = mini_batch_size * accum_steps
+        if nthreads is None:
+            blas_limits = contextlib.nullcontext()
+        else:
+            from threadpoolctl import threadpool_limits
+
+            if nthreads == "auto":
+                nthreads = self._autotune_threads(
+                    X_all[:, :batch_size], Y_all[:, :batch_size]
+                )
+                print(f"BLAS threads: {nthreads}")
+            blas_limits = threadpool_limits(limits=nthreads, user_api="blas")
+
+        with blas_limits:
+            for j in range(epochs):
+                # shuffle with one gather per epoch into a Fortran-ordered
+                # copy; every minibatch is then a contiguous, zero-copy
+                # column slice of it, whose transpose in backprop is
+                # C-contiguous, so the first-layer weight gradient is a
+                # plain no-transpose gemm
+                perm = np.random.permutation(n)
+                X_shuf = np.asfortranarray(X_all[:, perm])
+                Y_shuf = np.asfortranarray(Y_all[:, perm])
+                for k in range(0, n, batch_size):
+                    self.update_mini_batch(
+                        X_shuf[:, k : k + batch_size],
+                        Y_shuf[:, k : k + batch_size],
+                        eta,
+                        lmbda,
+                        n,
+                        mu,
+                    )
+
+                if test_data:
+                    corrects = self.evaluate_stacked(X_test, test_labels)
+                    print("Epoch {} : {} / {}".format(j, corrects, n_test))
+
+                    # the learning rate schedule is driven by test accuracy
+                    if self.learning_rate.should_halve(corrects):
+                        eta /= 2
+                        print(f"learning halved to: {eta}")
+                else:
+                    print("Epoch {} complete".format(j))
+
+                num_halves = self.learning_rate.get_num_halves()
+                print(f"num halves: {num_halves}")
+                if num_halves >= 7:  # stop training when learning_rate is 1/128 of original
+                    break
+
+    def _autotune_threads(self, X, Y, repeats=20):
+        """Return the BLAS thread count, out of powers of two up to the
+        number of CPUs, for which ``backprop`` on the minibatch ``X``,
+        ``Y`` runs fastest.  The weights are not modified."""
+        from threadpoolctl import threadpool_limits
+
+        n_cpus = os.cpu_count() or 1
+        candidates = sorted(
+            {2**i for i in range(n_cpus.bit_length()) if 2**i <= n_cpus} | {n_cpus}
+        )
+        timings = {}
+        for nthreads in candidates:
+            with threadpool_limits(limits=nthreads, user_api="blas"):
+                self.backprop(X, Y)  # warm up the thread pool
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    self.backprop(X, Y)
+                timings[nthreads] = time.perf_counter() - start
+        return min(timings, key=timings.get)
+
+    def update_mini_batch(self, X, Y, eta, lmbda, n, mu):
         """Update the network's weights and biases by applying
         gradient descent using backpropagation to a single mini batch.
-        The ``mini_batch`` is a list of tuples ``(x, y)``, and ``eta``
-        is the learning rate."""
-        velocities = [np.zeros(w.shape) for w in self.weights]
-        X = np.column_stack([x for x, y in mini_batch])
-        Y = np.column_stack([y for x, y in mini_batch])
-
+        The columns of ``X`` and ``Y`` are the inputs and desired
+        outputs of the mini batch, and ``eta`` is the learning rate."""
         nabla_b, nabla_w = self.backprop(X, Y)
 
         self.weights, self.biases, self.velocities = self.reg.update_step(
@@ -239,68 +368,179 @@ class Network(object):
             mu,
         )
 
+    def _alloc_buffers(self, mb_size, dtype):
+        """Select the per-layer arrays of type ``dtype`` used by
+        ``backprop`` for minibatches of ``mb_size`` examples, so that
+        they can be reused across minibatches instead of being allocated
+        every step.  The arrays are cached per minibatch size and dtype,
+        so a smaller final minibatch in each epoch does not force a
+        reallocation."""
+        key = (mb_size, dtype)
+        if key not in self._buffer_sets:
+            z = [np.empty((y, mb_size), dtype=dtype) for y in self.sizes[1:]]
+            a = [np.empty((y, mb_size), dtype=dtype) for y in self.sizes[1:]]
+            delta = [np.empty((y, mb_size), dtype=dtype) for y in self.sizes[1:]]
+            sp = [np.empty((y, mb_size), dtype=dtype) for y in self.sizes[1:]]
+            ones = np.ones(mb_size, dtype=dtype)  # sums rows via gemv
+            nabla_b = [np.empty(b.shape, dtype=dtype) for b in self.biases]
+            nabla_w = [np.empty(w.shape, dtype=dtype) for w in self.weights]
+            # views built once so the backward loop only issues BLAS/ufunc calls
+            nabla_b_col = [nb[:, 0] for nb in nabla_b]
+            a_T = [act.transpose() for act in a]
+            self._buffer_sets[key] = (
+                z, a, delta, sp, ones, nabla_b, nabla_w, nabla_b_col, a_T
+            )
+        (
+            self._z,
+            self._a,
+            self._delta,
+            self._sp,
+            self._ones,
+            self._nabla_b,
+            self._nabla_w,
+            self._nabla_b_col,
+            self._a_T,
+        ) = self._buffer_sets[key]
+        self._buffer_key = key
+
     def backprop(self, X, Y):
         """Return a tuple ``(nabla_b, nabla_w)`` representing the
         gradient for the cost function C_x.  ``nabla_b`` and
         ``nabla_w`` are layer-by-layer lists of numpy arrays, similar
-        to ``self.biases`` and ``self.weights``."""
-        nabla_b = [np.zeros(b.shape) for b in self.biases]
-        nabla_w = [np.zeros(w.shape) for w in self.weights]
+        to ``self.biases`` and ``self.weights``.  The returned arrays
+        are reused buffers and are overwritten by the next call."""
+        # the buffers follow the parameters' dtype (float32 unless the
+        # user assigned other weights); for SGD's minibatches the casts
+        # below are no-ops
+        dtype = np.result_type(*self.weights, *self.biases)
+        X = np.asarray(X, dtype=dtype)
+        Y = np.asarray(Y, dtype=dtype)
+        m = X.shape[1]
+        if (m, dtype) != self._buffer_key:
+            self._alloc_buffers(m, dtype)
+        nabla_b = self._nabla_b
+        nabla_w = self._nabla_w
         # feedforward
         activation = X
-        activations = [X]  # list to store all the activations, layer by layer
-        zs = []  # list to store all the z vectors, layer by layer
-        for b, w in zip(self.biases, self.weights):
-            z = (
-                np.dot(w, activation) + b
-            )  # this is the same as adding hte matrix B, it is called numpy broadcasting
-            zs.append(z)
-            activation = sigmoid(z)
-            activations.append(activation)  # 2), pg.38, Nueral Nets
+        activations = [X] + self._a  # all the activations, layer by layer
+        activations_T = [X.transpose()] + self._a_T
+        zs = self._z  # all the z vectors, layer by layer
+        for b, w, z, a, f in zip(
+            self.biases, self.weights, zs, self._a, self._activation_fns()
+        ):
+            np.dot(w, activation, out=z)
+            np.add(z, b, out=z)  # numpy broadcasting adds b to every column
+            f(z, out=a)  # 2), pg.38, Nueral Nets
+            activation = a
         # backward pass
-        delta = (self.cost).delta(zs[-1], activations[-1], Y)
+        delta = (self.cost).delta(zs[-1], activations[-1], Y, out=self._delta[-1])
+        # scale delta by 1/m once here instead of averaging every gradient;
+        # delta^l is linear in delta^L, so every layer inherits the factor
+        delta *= 1.0 / m
         # step 1 of algorithm, y is (0,..1,...0)T
-        nabla_b[-1] = np.mean(delta, axis=1, keepdims=True)  
-        nabla_w[-1] = np.dot(delta, activations[-2].transpose()) / X.shape[1]
+        ones = self._ones
+        np.dot(delta, ones, out=self._nabla_b_col[-1])
+        np.dot(delta, activations_T[-2], out=nabla_w[-1])
         for l in range(2, self.num_layers):
-            z = zs[-l]
-            sp = sigmoid_prime(z)
-            delta = (
-                np.dot(self.weights[-l + 1].transpose(), delta) * sp
-            )  # for l = L-1, ..., 2, compute delta^l
-            nabla_b[-l] = np.mean(delta, axis=1, keepdims=True)
-            nabla_w[-l] = np.dot(delta, activations[-l - 1].transpose()) / X.shape[1]
+            # for l = L-1, ..., 2, compute delta^l
+            delta_l = self._delta[-l]
+            sp = self._sp[-l]
+            np.dot(self.weights[-l + 1].transpose(), delta, out=delta_l)
+            sigmoid_prime_from_a(activations[-l], out=sp)
+            delta_l *= sp
+            delta = delta_l
+            np.dot(delta, ones, out=self._nabla_b_col[-l])
+            np.dot(delta, activations_T[-l - 1], out=nabla_w[-l])
         return (nabla_b, nabla_w)
-    
+
     def feedforward(self, a):
-        """Return the output of the network if ``a`` is input."""
-        for b, w in zip(self.biases, self.weights):
-            a = sigmoid(np.dot(w, a)+b)
+        """Return the output of the network if ``a`` is input.  ``a``
+        may also be a matrix whose columns are separate inputs."""
+        for b, w, f in zip(self.biases, self.weights, self._activation_fns()):
+            # one array per layer: the bias add and activation reuse z
+            z = np.dot(w, a)
+            z += b
+            a = f(z, out=z)
         return a
 
+    def _activation_fns(self):
+        """Return the activation function of each layer after the input
+        layer: sigmoid for the hidden layers, and for the output layer
+        whatever the cost function expects."""
+        return [sigmoid] * (self.num_layers - 2) + [self.cost.output]
+
     def evaluate(self, test_data):
         """Return the number of test inputs for which the neural
         network outputs the correct result. Note that the neural
         network's output is assumed to be the index of whichever
-        neuron in the final layer has the highest activation."""
-        test_results = [
-            (
-                np.argmax(self.feedforward(x)),
-                y,
-            )  # tuples are (larget output activation index , label)
-            for (x, y) in test_data
-        ]
-        return sum(int(x == y) for (x, y) in test_results)
+        neuron in the final layer has the highest activation.  The
+        test inputs are stacked into one matrix and fed forward
+        together."""
+        return self.evaluate_stacked(*stack_test_data(test_data))
+
+    def evaluate_stacked(self, X, labels):
+        """Like ``evaluate``, but for test inputs already stacked as the
+        columns of ``X`` with the matching digit ``labels``, as
+        returned by ``stack_test_data``."""
+        # column j of the output holds the activations for test input j
+        predictions = np.argmax(self.feedforward(X), axis=0)
+        return int(np.sum(predictions == labels))
 
 
 #### Miscellaneous functions
-def sigmoid(z):
-    """The sigmoid function."""
-    return 1.0 / (1.0 + np.exp(-z))
+def _positive_int(name, value, alternatives=""):
+    """Return ``value`` as an int, raising ``ValueError`` naming the
+    argument ``name`` unless it is an integer of at least 1."""
+    message = f"{name} must be an integer >= 1 {alternatives}".rstrip()
+    if isinstance(value, bool):
+        raise ValueError(f"{message}, got {value!r}")
+    try:
+        value = operator.index(value)
+    except TypeError:
+        raise ValueError(f"{message}, got {value!r}") from None
+    if value < 1:
+        raise ValueError(f"{message}, got {value!r}")
+    return value
+
+
+def stack_test_data(test_data):
+    """Return ``(X, labels)`` for a list of ``(x, y)`` test tuples:
+    the inputs as the columns of one float32 matrix, and the labels as
+    an array."""
+    X = np.column_stack([x for x, y in test_data]).astype(np.float32)
+    labels = np.array([y for x, y in test_data])
+    return X, labels
+
+
+def sigmoid(z, out=None):
+    """The sigmoid function.  ``expit`` evaluates it in a single pass
+    over ``z``; if ``out`` is given the result is written there."""
+    return expit(z, out=out)
+
+
+def softmax(z, out=None):
+    """The softmax function over each column of ``z``.  The column
+    maximum is subtracted first so ``exp`` cannot overflow; if ``out``
+    is given (it may be ``z`` itself) the result is written there."""
+    out = np.subtract(z, z.max(axis=0), out=out)
+    np.exp(out, out=out)
+    out /= out.sum(axis=0)
+    return out
 
 
 def sigmoid_prime(z):
     """Derivative of the sigmoid function."""
-    return sigmoid(z) * (1 - sigmoid(z))
+    s = sigmoid(z)
+    return s * (1 - s)
+
+
+def sigmoid_prime_from_a(a, out=None):
+    """Derivative of the sigmoid function, expressed in terms of the
+    already computed activation ``a = sigmoid(z)``, so no further
+    ``exp`` passes are needed.  If ``out`` is given the result is
+    written there without allocating any temporaries."""
+    out = np.subtract(1, a, out=out)
+    out *= a
+    return out
 
 